@@ -5,17 +5,21 @@ Fixed to group by destination and show correct order
 """
 import os
 import asyncio
-import json
+import time
 from datetime import datetime, timedelta, timezone
-from typing import List, Dict, Optional
+from typing import Any, List, Dict, Optional, Set
 import httpx
+import redis.asyncio as redis
+import orjson
+import msgspec
 from pydantic import BaseModel, validator
 from fastapi import FastAPI, Request, BackgroundTasks, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+from operator import attrgetter
 import logging
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
@@ -26,6 +30,20 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+STOCKHOLM_TZ = ZoneInfo('Europe/Stockholm')
+
+# Last formatted timestamp and the time it was taken
+_last_iso_cache = ["", 0.0]
+
+
+def now_iso() -> str:
+    """Current Stockholm time as a second-precision ISO string, reused for up to 0.5s"""
+    t = time.time()
+    if t - _last_iso_cache[1] > 0.5:
+        _last_iso_cache[0] = datetime.fromtimestamp(t, STOCKHOLM_TZ).isoformat(timespec="seconds")
+        _last_iso_cache[1] = t
+    return _last_iso_cache[0]
+
 # Global variables for caching data
 bus_data_cache = {
     "departures": [],
@@ -34,34 +52,94 @@ bus_data_cache = {
     "error": None
 }
 
+class Departure(msgspec.Struct):
+    """Single bus departure as served to API and WebSocket clients"""
+    line: str
+    destination: str
+    expected_time: str
+    direction: str
+    real_time: bool
+
+
+class BusData(msgspec.Struct):
+    """Shape of a processed departures result, used to decode it from Redis"""
+    departures: List[Departure]
+    departures_by_destination: Dict[str, List[Departure]]
+    last_updated: Optional[str]
+    error: Optional[str]
+    source: str
+
+
+class CachedBusData(msgspec.Struct):
+    """Processed departures as stored in Redis, with when their fetch started and finished"""
+    started_at: float
+    fetched_at: float
+    data: BusData
+
+# Serialized copy of bus_data_cache, refreshed on every cache update. This is the
+# in-process tier in front of Redis: API and WebSocket reads never touch Redis.
+bus_data_payload: bytes = msgspec.json.encode(bus_data_cache)
+
+
+def set_bus_data(new_data: Dict) -> bytes:
+    """Update the cache and serialize it once for API and WebSocket clients"""
+    global bus_data_payload
+    bus_data_cache.update(new_data)
+    bus_data_payload = msgspec.json.encode(bus_data_cache)
+    return bus_data_payload
+
 # WebSocket connections manager
 class ConnectionManager:
-    def __init__(self, max_connections: int = 100):
-        self.active_connections: List[WebSocket] = []
+    def __init__(self, max_connections: int = 100, queue_size: int = 8):
+        self.active_connections: Set[WebSocket] = set()
         self.max_connections = max_connections
+        self.queue_size = queue_size
+        # Per-connection outgoing queues, drained by one writer task each
+        self.queues: Dict[WebSocket, asyncio.Queue] = {}
+        self.writers: Dict[WebSocket, asyncio.Task] = {}
 
     async def connect(self, websocket: WebSocket):
         if len(self.active_connections) >= self.max_connections:
             await websocket.close(code=1008, reason="Connection limit reached")
             return False
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
+        self.queues[websocket] = asyncio.Queue(maxsize=self.queue_size)
+        self.writers[websocket] = asyncio.create_task(self._writer(websocket))
         return True
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
-
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
-                # Remove disconnected connections
-                if connection in self.active_connections:
-                    self.active_connections.remove(connection)
+        self.active_connections.discard(websocket)
+        self.queues.pop(websocket, None)
+        writer = self.writers.pop(websocket, None)
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+
+    async def _writer(self, websocket: WebSocket):
+        """Send queued messages to a single client until it goes away"""
+        queue = self.queues[websocket]
+        try:
+            while True:
+                message = await queue.get()
+                await websocket.send_bytes(message)
+        except Exception as e:
+            logger.info(f"WebSocket writer stopped: {e!r}")
+        finally:
+            self.disconnect(websocket)
+
+    async def send_personal_message(self, message: bytes, websocket: WebSocket):
+        queue = self.queues.get(websocket)
+        if queue is None:
+            return
+        if queue.full():
+            # Every message is a full snapshot, so drop the oldest for slow clients
+            queue.get_nowait()
+        queue.put_nowait(message)
+
+    async def broadcast(self, message: bytes):
+        # Only enqueues, so a slow client never holds up the update cycle
+        for connection in tuple(self.active_connections):
+            await self.send_personal_message(message, connection)
 
 manager = ConnectionManager()
 
@@ -76,6 +154,20 @@ SL_API_CONFIG = {
     "target_destinations": ["Frihamnen", "Stora Essingen"]  # Expected destinations
 }
 
+# Lowercased target destination -> target destination, built once for routing
+_TARGET_INDEX = {t.lower(): t for t in SL_API_CONFIG["target_destinations"]}
+
+# Shared Redis cache so multiple workers only fetch once per interval (optional)
+REDIS_URL = os.getenv("REDIS_URL", "")
+REDIS_CACHE_KEY = "bus:line1:cache"
+REDIS_LOCK_KEY = "bus:line1:lock"
+REDIS_FRESH_AGE = SL_API_CONFIG["refresh_interval"] - 1  # seconds, older entries are refetched
+REDIS_CACHE_TTL = 2 * SL_API_CONFIG["refresh_interval"]  # seconds, stale entries kept for last-resort reads
+REDIS_FETCH_TIMEOUT = 25  # seconds, upper bound on a fetch made while holding the lock
+REDIS_LOCK_TTL = 30  # seconds, must stay above REDIS_FETCH_TIMEOUT
+
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
 # CORS proxies for handling CORS issues
 CORS_PROXIES = [
     "https://api.allorigins.win/get?url=",
@@ -83,13 +175,117 @@ CORS_PROXIES = [
     "https://api.codetabs.com/v1/proxy?quest="
 ]
 
+# Mock departures as (minutes from now, departure) pairs - CORRECTED destinations and order
+MOCK_DEPARTURES_TEMPLATE = [
+    # Toward Frihamnen (more frequent - city center direction)
+    (4, {"line": "1", "destination": "Frihamnen", "direction": "1", "real_time": True}),
+    (9, {"line": "1", "destination": "Frihamnen", "direction": "1", "real_time": False}),
+    # Toward Stora Essingen (return/depot direction - less frequent)
+    (12, {"line": "1", "destination": "Stora Essingen", "direction": "2", "real_time": True}),
+    (22, {"line": "1", "destination": "Stora Essingen", "direction": "2", "real_time": False}),
+]
+
 class BusDataFetcher:
     """Handles fetching and processing bus data from SL API"""
 
     def __init__(self):
-        self.client = httpx.AsyncClient(timeout=30.0)
+        # Keep connections alive between refreshes so each poll reuses the TLS session
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=10,
+                max_keepalive_connections=5,
+                keepalive_expiry=60.0
+            ),
+            http2=True,
+            headers={"user-agent": "bus-app/2.2"}
+        )
+
+    async def fetch_departures(self, force: bool = False) -> Dict:
+        """Fetch departures through the shared Redis cache when configured"""
+        if redis_client is None:
+            return await self.fetch_from_api()
+
+        # Entry age is measured from when its fetch started, so a slow fetch can't
+        # look fresh on the next tick. A forced refresh only accepts results that
+        # finished after it was requested.
+        requested_at = time.time()
+        if force:
+            fresh = {"fetched_after": requested_at}
+        else:
+            fresh = {"started_after": requested_at - REDIS_FRESH_AGE}
+        try:
+            if not force:
+                cached = await self._get_cached(**fresh)
+                if cached is not None:
+                    return cached
+
+            # Only the worker holding the lock talks to the SL API
+            lock = redis_client.lock(REDIS_LOCK_KEY, timeout=REDIS_LOCK_TTL)
+            if await lock.acquire(blocking=False):
+                try:
+                    started_at = time.time()
+                    data = await self._fetch_with_timeout()
+                    await self._set_cached(data, started_at)
+                    return data
+                finally:
+                    await self._release(lock)
+
+            # Another worker is fetching, wait for its result
+            for _ in range(REDIS_LOCK_TTL * 2):
+                await asyncio.sleep(0.5)
+                cached = await self._get_cached(**fresh)
+                if cached is not None:
+                    return cached
+
+            # The lock holder never delivered, serve a stale entry rather than stampede
+            cached = await self._get_cached()
+            if cached is not None:
+                logger.warning("Serving stale departures from Redis")
+                return cached
+        except redis.RedisError as e:
+            logger.warning(f"Redis cache unavailable: {e}")
+
+        return await self.fetch_from_api()
+
+    async def _fetch_with_timeout(self) -> Dict:
+        """Fetch from the API within REDIS_FETCH_TIMEOUT so the lock never expires mid-fetch"""
+        try:
+            return await asyncio.wait_for(self.fetch_from_api(), REDIS_FETCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Fetching departures timed out")
+            return self.get_mock_data()
 
-    async def fetch_departures(self) -> Dict:
+    async def _get_cached(self, started_after: float = 0, fetched_after: float = 0) -> Optional[Dict[str, Any]]:
+        """Read processed departures from Redis, or None on a miss or a too old entry"""
+        cached = await redis_client.get(REDIS_CACHE_KEY)
+        if cached is None:
+            return None
+        try:
+            entry = msgspec.json.decode(cached, type=CachedBusData)
+        except msgspec.DecodeError as e:
+            logger.warning(f"Ignoring undecodable Redis cache entry: {e}")
+            return None
+        if entry.started_at < started_after or entry.fetched_at < fetched_after:
+            return None
+        return msgspec.structs.asdict(entry.data)
+
+    async def _set_cached(self, data: Dict, started_at: float):
+        """Store processed departures in Redis, tagged with when the fetch started and finished"""
+        entry = {"started_at": started_at, "fetched_at": time.time(), "data": data}
+        try:
+            await redis_client.set(REDIS_CACHE_KEY, msgspec.json.encode(entry), ex=REDIS_CACHE_TTL)
+        except redis.RedisError as e:
+            logger.warning(f"Could not store departures in Redis: {e}")
+
+    async def _release(self, lock):
+        """Release the fetch lock if this worker still owns it"""
+        try:
+            await lock.release()
+        except redis.RedisError as e:
+            logger.warning(f"Could not release Redis fetch lock: {e}")
+
+    async def fetch_from_api(self) -> Dict:
         """Fetch departures with multiple fallback strategies"""
         api_url = f"{SL_API_CONFIG['base_url']}/sites/{SL_API_CONFIG['site_id']}/departures?transport=BUS&line=1&forecast=60"
 
@@ -97,32 +293,42 @@ class BusDataFetcher:
         try:
             response = await self.client.get(api_url)
             if response.status_code == 200:
-                data = response.json()
+                data = orjson.loads(response.content)
                 return self.process_departure_data(data)
         except Exception as e:
             logger.warning(f"Direct API call failed: {e}")
 
-        # Try CORS proxies
-        for proxy in CORS_PROXIES:
-            try:
-                proxy_url = proxy + api_url
-                response = await self.client.get(proxy_url)
-                if response.status_code == 200:
-                    # Handle different proxy response formats
-                    if "allorigins" in proxy:
-                        proxy_data = response.json()
-                        data = json.loads(proxy_data["contents"])
-                    else:
-                        data = response.json()
-                    return self.process_departure_data(data)
-            except Exception as e:
-                logger.warning(f"Proxy {proxy} failed: {e}")
-                continue
+        # Race CORS proxies and use the first successful response
+        tasks = {asyncio.create_task(self._try_proxy(proxy, api_url)) for proxy in CORS_PROXIES}
+        try:
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    data = task.result()
+                    if data is not None:
+                        return self.process_departure_data(data)
+        finally:
+            for task in tasks:
+                task.cancel()
 
         # Return mock data as fallback
         logger.info("Using mock data as fallback")
         return self.get_mock_data()
 
+    async def _try_proxy(self, proxy: str, url: str) -> Optional[Dict]:
+        """Fetch url through a single CORS proxy, returning None on failure"""
+        try:
+            response = await self.client.get(proxy + url)
+            if response.status_code == 200:
+                # Handle different proxy response formats
+                if "allorigins" in proxy:
+                    proxy_data = orjson.loads(response.content)
+                    return orjson.loads(proxy_data["contents"])
+                return orjson.loads(response.content)
+        except Exception as e:
+            logger.warning(f"Proxy {proxy} failed: {e}")
+        return None
+
     def process_departure_data(self, data: Dict) -> Dict:
         """Process API response data - FIXED to group by destination"""
         try:
@@ -130,53 +336,63 @@ class BusDataFetcher:
             if data and "departures" in data:
                 for dep in data["departures"]:
                     line = dep.get("line", {})
-                    if isinstance(line, dict):
-                        line_designation = line.get("designation", "")
-                    else:
-                        line_designation = str(line)
+                    # Exact type check skips the MRO walk; the API sends a dict in practice
+                    line_designation = line.get("designation", "") if type(line) is dict else str(line)
 
                     if line_designation == SL_API_CONFIG["bus_line"]:
-                        departure = {
-                            "line": line_designation,
-                            "destination": dep.get("destination", "Okänd destination"),
-                            "expected_time": dep.get("expected") or dep.get("planned"),
-                            "direction": dep.get("direction", ""),
-                            "real_time": dep.get("expected") is not None
-                        }
+                        departure = Departure(
+                            line=line_designation,
+                            destination=dep.get("destination", "Okänd destination"),
+                            expected_time=dep.get("expected") or dep.get("planned") or "",
+                            direction=dep.get("direction", ""),
+                            real_time=dep.get("expected") is not None
+                        )
                         all_departures.append(departure)
 
             # Sort by expected time first
-            all_departures.sort(key=lambda x: x["expected_time"] or "")
+            all_departures.sort(key=attrgetter("expected_time"))
 
             # Group by destination and limit to 2 per destination
-            departures_by_destination = {}
-            final_departures = []
-
-            # Process each target destination
-            for target_dest in SL_API_CONFIG["target_destinations"]:
-                departures_by_destination[target_dest] = []
-
-                # Find departures for this destination
-                dest_departures = [
-                    dep for dep in all_departures 
-                    if target_dest.lower() in dep["destination"].lower()
-                ][:SL_API_CONFIG["departures_per_destination"]]
-
-                departures_by_destination[target_dest] = dest_departures
-                final_departures.extend(dest_departures)
+            target_destinations = SL_API_CONFIG["target_destinations"]
+            per_destination = SL_API_CONFIG["departures_per_destination"]
+            departures_by_destination = {t: [] for t in target_destinations}
+            remaining_slots = per_destination * len(target_destinations)
+
+            # Single pass over the sorted departures, stopping once every bucket is full
+            for dep in all_departures:
+                dest_lower = dep.destination.lower()
+                target_dest = _TARGET_INDEX.get(dest_lower)
+                if target_dest is None or len(departures_by_destination[target_dest]) >= per_destination:
+                    # Fall back to substring matching for decorated destination names
+                    target_dest = next(
+                        (t for target_lower, t in _TARGET_INDEX.items()
+                         if target_lower in dest_lower and len(departures_by_destination[t]) < per_destination),
+                        None
+                    )
+                if target_dest is not None:
+                    departures_by_destination[target_dest].append(dep)
+                    remaining_slots -= 1
+                    if not remaining_slots:
+                        break
+
+            final_departures = [
+                dep for target_dest in target_destinations
+                for dep in departures_by_destination[target_dest]
+            ]
 
             # If we don't have enough departures, add any remaining ones
             if len(final_departures) < 4:
+                seen = {id(dep) for dep in final_departures}
                 remaining_departures = [
                     dep for dep in all_departures 
-                    if dep not in final_departures
+                    if id(dep) not in seen
                 ][:4 - len(final_departures)]
                 final_departures.extend(remaining_departures)
 
             return {
                 "departures": final_departures,
                 "departures_by_destination": departures_by_destination,
-                "last_updated": datetime.now(tz=ZoneInfo('Europe/Stockholm')).isoformat(),
+                "last_updated": now_iso(),
                 "error": None,
                 "source": "real_api"
             }
@@ -186,52 +402,20 @@ class BusDataFetcher:
 
     def get_mock_data(self) -> Dict:
         """Generate mock data for demonstration - CORRECTED destinations and order"""
-        now = datetime.now(tz=ZoneInfo('Europe/Stockholm'))
-
-        # Create departures with correct destinations and realistic times
-        mock_departures = [
-            # Toward Frihamnen (more frequent - city center direction)
-            {
-                "line": "1",
-                "destination": "Frihamnen",
-                "expected_time": (now + timedelta(minutes=4)).isoformat(),
-                "direction": "1",
-                "real_time": True
-            },
-            {
-                "line": "1",
-                "destination": "Frihamnen", 
-                "expected_time": (now + timedelta(minutes=9)).isoformat(),
-                "direction": "1",
-                "real_time": False
-            },
-            # Toward Stora Essingen (return/depot direction - less frequent)
-            {
-                "line": "1",
-                "destination": "Stora Essingen",
-                "expected_time": (now + timedelta(minutes=12)).isoformat(),
-                "direction": "2",
-                "real_time": True
-            },
-            {
-                "line": "1",
-                "destination": "Stora Essingen",
-                "expected_time": (now + timedelta(minutes=22)).isoformat(),
-                "direction": "2", 
-                "real_time": False
-            }
-        ]
+        now = datetime.now(tz=STOCKHOLM_TZ)
 
-        # Group by destination
-        departures_by_destination = {
-            "Frihamnen": [dep for dep in mock_departures if dep["destination"] == "Frihamnen"],
-            "Stora Essingen": [dep for dep in mock_departures if dep["destination"] == "Stora Essingen"]
-        }
+        # Fill in expected times relative to now
+        mock_departures = []
+        departures_by_destination = {}
+        for offset, template in MOCK_DEPARTURES_TEMPLATE:
+            departure = Departure(expected_time=(now + timedelta(minutes=offset)).isoformat(), **template)
+            mock_departures.append(departure)
+            departures_by_destination.setdefault(departure.destination, []).append(departure)
 
         return {
             "departures": mock_departures,
             "departures_by_destination": departures_by_destination,
-            "last_updated": now.isoformat(),
+            "last_updated": now_iso(),
             "error": "Using demonstration data - live API unavailable",
             "source": "mock_data"
         }
@@ -239,29 +423,48 @@ class BusDataFetcher:
 # Initialize bus data fetcher
 bus_fetcher = BusDataFetcher()
 
+# Serializes fetches so a manual refresh never overlaps the periodic one
+fetch_lock = asyncio.Lock()
+# Monotonic time the most recent fetch finished
+last_fetch_completed = 0.0
+
+
+async def fetch_bus_data(force: bool = False, requested_at: Optional[float] = None) -> Optional[Dict]:
+    """Fetch departures under fetch_lock, or return None if a fetch finished after requested_at"""
+    global last_fetch_completed
+    async with fetch_lock:
+        if requested_at is not None and last_fetch_completed >= requested_at:
+            return None
+        new_data = await bus_fetcher.fetch_departures(force=force)
+        last_fetch_completed = time.monotonic()
+        return new_data
+
 # Background task for periodic data updates
 async def update_bus_data():
     """Background task to update bus data periodically"""
+    loop = asyncio.get_running_loop()
+    next_deadline = loop.time()
     while True:
+        # Wait for next update on a fixed schedule, so fetch time doesn't add drift.
+        # The first update is one interval after startup, which does the initial fetch.
+        next_deadline = max(next_deadline + SL_API_CONFIG["refresh_interval"], loop.time())
+        await asyncio.sleep(next_deadline - loop.time())
+
         try:
             logger.info("Updating bus data...")
-            new_data = await bus_fetcher.fetch_departures()
+            new_data = await fetch_bus_data()
 
             # Update global cache
-            global bus_data_cache
-            bus_data_cache.update(new_data)
+            payload = set_bus_data(new_data)
 
             # Broadcast to WebSocket connections
-            await manager.broadcast(json.dumps(new_data))
+            await manager.broadcast(payload)
 
             logger.info(f"Bus data updated. Found {len(new_data['departures'])} departures")
 
         except Exception as e:
             logger.error(f"Error updating bus data: {e}")
-            bus_data_cache["error"] = str(e)
-
-        # Wait for next update
-        await asyncio.sleep(SL_API_CONFIG["refresh_interval"])
+            set_bus_data({"error": str(e)})
 
 # Lifespan context manager
 @asynccontextmanager
@@ -269,19 +472,21 @@ async def lifespan(app: FastAPI):
     # Startup
     logger.info("Starting up Stockholm Bus Countdown App...")
 
+    # Initial data fetch
+    initial_data = await fetch_bus_data()
+    set_bus_data(initial_data)
+
     # Start background task for data updates
     task = asyncio.create_task(update_bus_data())
 
-    # Initial data fetch
-    initial_data = await bus_fetcher.fetch_departures()
-    bus_data_cache.update(initial_data)
-
     yield
 
     # Shutdown
     logger.info("Shutting down...")
     task.cancel()
     await bus_fetcher.client.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -357,6 +562,9 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # Templates
 templates = Jinja2Templates(directory="templates")
+# Let the |tojson filter encode Departure structs
+templates.env.policies["json.dumps_function"] = lambda obj, **kwargs: msgspec.json.encode(obj).decode()
+templates.env.policies["json.dumps_kwargs"] = {}
 
 # Routes
 @app.get("/", response_class=HTMLResponse)
@@ -374,7 +582,7 @@ async def index(request: Request):
 @app.get("/api/departures")
 async def get_departures():
     """API endpoint for getting current departures"""
-    return JSONResponse(bus_data_cache)
+    return Response(content=bus_data_payload, media_type="application/json")
 
 
 class RefreshRequest(BaseModel):
@@ -388,11 +596,14 @@ class RefreshRequest(BaseModel):
 @app.post("/api/refresh")
 async def refresh_departures(request: RefreshRequest, background_tasks: BackgroundTasks):
     """Manually refresh departure data"""
+    requested_at = time.monotonic()
+
     async def refresh_task():
-        global bus_data_cache
-        new_data = await bus_fetcher.fetch_departures()
-        bus_data_cache.update(new_data)
-        await manager.broadcast(json.dumps(new_data))
+        new_data = await fetch_bus_data(force=True, requested_at=requested_at)
+        if new_data is None:
+            # Another fetch finished after this request, its result is already broadcast
+            return
+        await manager.broadcast(set_bus_data(new_data))
 
     background_tasks.add_task(refresh_task)
     return {"message": "Refresh triggered"}
@@ -400,18 +611,19 @@ async def refresh_departures(request: RefreshRequest, background_tasks: Backgrou
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint for real-time updates"""
-    await manager.connect(websocket)
+    if not await manager.connect(websocket):
+        return
 
     # Send current data immediately
-    await websocket.send_text(json.dumps(bus_data_cache))
+    await manager.send_personal_message(bus_data_payload, websocket)
 
     try:
         while True:
-            # Keep connection alive and handle client messages
-            data = await websocket.receive_text()
-            if data == "ping":
-                await websocket.send_text("pong")
+            # Wait for disconnect; keepalive uses protocol-level ping frames
+            await websocket.receive_text()
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
 
 @app.get("/health")
@@ -434,5 +646,10 @@ if __name__ == "__main__":
         host="0.0.0.0",
         port=port,  # Use Render's PORT environment variable
         reload=False,  # Disable reload in production
+        # loop/http stay on "auto": uvicorn[standard] picks uvloop and httptools where available
+        ws="websockets",
+        ws_ping_interval=20,
+        ws_ping_timeout=10,
+        ws_per_message_deflate=False,  # Don't re-compress the same broadcast per client
         log_level="info"
     )